@@ -1,21 +1,120 @@
+import argparse
+import asyncio
 import requests
+import httpx
 import json
 import os
-from typing import Dict, Any, Optional
+import time
+from collections import deque
+from typing import Dict, Any, List, Optional
 
-class ChatClient:
+# チャット履歴の最大保持件数（古いものから破棄）
+DEFAULT_MAX_HISTORY = 100
+
+# 負荷試験で再生する標準の会話（6ターンで情報を揃え、最後のターンで旅行プランを生成）
+DEFAULT_DIALOGUE = [
+    "こんにちは",
+    "甲府から河口湖に行きたいです",
+    "車で行きます",
+    "予算は3000円です",
+    "12時頃に着きたいです",
+    "和食が好きです"
+]
+
+
+class BaseChatClient:
+    """チャット履歴の管理（同期・非同期クライアント共通）"""
+
+    def __init__(self, base_url: str = "http://localhost:5000", max_history: int = DEFAULT_MAX_HISTORY):
+        """
+        初期化
+
+        Args:
+            base_url: サーバーのベースURL
+            max_history: チャット履歴の最大保持件数
+        """
+        self.base_url = base_url
+        self.messages = deque(maxlen=max_history)  # チャット履歴を保存（リングバッファ）
+
+    def append_message(self, message: str, sender: str):
+        """
+        メッセージを履歴に追加する
+        
+        Args:
+            message: メッセージ内容
+            sender: 送信者（'user' または 'ai'）
+        """
+        self.messages.append({
+            'message': message,
+            'sender': sender,
+            'timestamp': self._get_current_time()
+        })
+    
+    def get_chat_history(self) -> list:
+        """
+        チャット履歴を取得する
+        
+        Returns:
+            チャット履歴のリスト
+        """
+        return list(self.messages)
+    
+    def display_chat_history(self):
+        """チャット履歴をコンソールに表示する"""
+        print("\n=== チャット履歴 ===")
+        for msg in self.messages:
+            sender_label = "あなた" if msg['sender'] == 'user' else "AI"
+            print(f"[{msg['timestamp']}] {sender_label}: {msg['message']}")
+        print("==================\n")
+    
+    def clear_history(self):
+        """チャット履歴をクリアする"""
+        self.messages.clear()
+    
+    def save_map_data(self, map_data: Optional[Dict[str, Any]], filename: str = None) -> Optional[str]:
+        """
+        地図データを保存する
+        
+        Args:
+            map_data: 地図データ
+            filename: 保存ファイル名（指定しない場合は自動生成）
+            
+        Returns:
+            保存したファイルパス（保存に失敗した場合はNone）
+        """
+        if not map_data:
+            return None
+        
+        if not filename:
+            filename = f"map_data_{self._get_current_time().replace(':', '-')}.json"
+        
+        try:
+            with open(filename, 'w', encoding='utf-8') as f:
+                json.dump(map_data, f, ensure_ascii=False, indent=2)
+            return filename
+        except Exception as e:
+            print(f"地図データの保存に失敗しました: {e}")
+            return None
+    
+    def _get_current_time(self) -> str:
+        """現在時刻を文字列で取得する"""
+        from datetime import datetime
+        return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+class ChatClient(BaseChatClient):
     """山梨県観光AIコンシェルジュのクライアント実装"""
     
-    def __init__(self, base_url: str = "http://localhost:5000"):
+    def __init__(self, base_url: str = "http://localhost:5000", max_history: int = DEFAULT_MAX_HISTORY):
         """
         初期化
         
         Args:
             base_url: サーバーのベースURL
+            max_history: チャット履歴の最大保持件数
         """
-        self.base_url = base_url
+        super().__init__(base_url, max_history)
         self.session = requests.Session()
-        self.messages = []  # チャット履歴を保存
     
     def send_message(self, message: str) -> Dict[str, Any]:
         """
@@ -73,76 +172,216 @@ class ChatClient:
             error_msg = f"予期しないエラー: {str(e)}"
             self.append_message('申し訳ありません。エラーが発生しました。', 'ai')
             return {"error": error_msg}
-    
-    def append_message(self, message: str, sender: str):
+
+
+class AsyncChatClient(BaseChatClient):
+    """非同期版のクライアント実装（1インスタンスが1つの会話・Cookieセッションに対応）"""
+
+    def __init__(self, base_url: str = "http://localhost:5000", max_history: int = DEFAULT_MAX_HISTORY,
+                 transport: Optional[httpx.AsyncBaseTransport] = None, timeout: float = 30.0):
         """
-        メッセージを履歴に追加する
-        
+        初期化
+
         Args:
-            message: メッセージ内容
-            sender: 送信者（'user' または 'ai'）
+            base_url: サーバーのベースURL
+            max_history: チャット履歴の最大保持件数
+            transport: 共有するコネクションプール（指定しない場合はクライアントごとに作成）
+            timeout: リクエストのタイムアウト（秒）
         """
-        self.messages.append({
-            'message': message,
-            'sender': sender,
-            'timestamp': self._get_current_time()
-        })
-    
-    def get_chat_history(self) -> list:
+        super().__init__(base_url, max_history)
+        # Cookieは会話ごとに分離し、コネクションプール（transport）だけを共有する
+        self._owns_transport = transport is None
+        self.client = httpx.AsyncClient(base_url=base_url, transport=transport, timeout=timeout)
+
+    async def send_message(self, message: str) -> Dict[str, Any]:
         """
-        チャット履歴を取得する
-        
+        メッセージを送信してAIの応答を取得する
+
+        Args:
+            message: 送信するメッセージ
+
         Returns:
-            チャット履歴のリスト
+            AIの応答データ（response, map_data含む）
         """
-        return self.messages.copy()
-    
-    def display_chat_history(self):
-        """チャット履歴をコンソールに表示する"""
-        print("\n=== チャット履歴 ===")
-        for msg in self.messages:
-            sender_label = "あなた" if msg['sender'] == 'user' else "AI"
-            print(f"[{msg['timestamp']}] {sender_label}: {msg['message']}")
-        print("==================\n")
-    
-    def clear_history(self):
-        """チャット履歴をクリアする"""
-        self.messages.clear()
-    
-    def save_map_data(self, map_data: Optional[Dict[str, Any]], filename: str = None) -> Optional[str]:
+        if not message.strip():
+            return {"error": "メッセージが空です"}
+
+        # ユーザーメッセージを履歴に追加
+        self.append_message(message, 'user')
+
+        try:
+            response = await self.client.post('/chat', json={'message': message})
+
+            if response.status_code == 200:
+                data = response.json()
+
+                if data.get('error'):
+                    self.append_message('申し訳ありません。エラーが発生しました。', 'ai')
+                    return data
+
+                # AIの応答を履歴に追加
+                if data.get('response'):
+                    self.append_message(data['response'], 'ai')
+
+                return data
+
+            else:
+                error_msg = f"HTTPエラー: {response.status_code}"
+                self.append_message('申し訳ありません。エラーが発生しました。', 'ai')
+                return {"error": error_msg, "status_code": response.status_code}
+
+        except httpx.TimeoutException:
+            error_msg = "タイムアウトエラーが発生しました"
+            self.append_message('申し訳ありません。エラーが発生しました。', 'ai')
+            return {"error": error_msg}
+
+        except httpx.TransportError:
+            error_msg = "サーバーに接続できませんでした"
+            self.append_message('申し訳ありません。エラーが発生しました。', 'ai')
+            return {"error": error_msg}
+
+        except Exception as e:
+            error_msg = f"予期しないエラー: {str(e)}"
+            self.append_message('申し訳ありません。エラーが発生しました。', 'ai')
+            return {"error": error_msg}
+
+    async def aclose(self):
+        """接続を閉じる（共有のコネクションプールは閉じない）"""
+        if self._owns_transport:
+            await self.client.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
+
+
+def percentile(values: List[float], ratio: float) -> float:
+    """ソート済みでないリストからパーセンタイル値を求める"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * ratio))]
+
+
+class LoadGenerator:
+    """台本の会話を指定レートで同時に再生し、ターンごとのレイテンシを記録する負荷試験ツール"""
+
+    def __init__(self, base_url: str = "http://localhost:5000", dialogue: Optional[List[str]] = None,
+                 rate: float = 1.0, max_connections: int = 100, max_history: int = 20,
+                 timeout: float = 30.0):
         """
-        地図データを保存する
-        
+        初期化
+
         Args:
-            map_data: 地図データ
-            filename: 保存ファイル名（指定しない場合は自動生成）
-            
+            base_url: サーバーのベースURL
+            dialogue: 各会話で順に送信するメッセージ（指定しない場合は DEFAULT_DIALOGUE）
+            rate: 1秒あたりに開始する会話数
+            max_connections: 共有コネクションプールの最大接続数
+            max_history: 会話ごとのチャット履歴の最大保持件数
+            timeout: リクエストのタイムアウト（秒）
+        """
+        self.base_url = base_url
+        self.dialogue = dialogue or DEFAULT_DIALOGUE
+        self.rate = rate
+        self.max_connections = max_connections
+        self.max_history = max_history
+        self.timeout = timeout
+        self.results = []  # ターンごとの計測結果
+
+    async def _run_conversation(self, conversation_id: int, transport: httpx.AsyncBaseTransport):
+        """1つの会話を最初から最後まで再生する"""
+        async with AsyncChatClient(self.base_url, self.max_history, transport, self.timeout) as client:
+            for turn, message in enumerate(self.dialogue):
+                started_at = time.perf_counter()
+                data = await client.send_message(message)
+                latency = time.perf_counter() - started_at
+
+                self.results.append({
+                    'conversation': conversation_id,
+                    'turn': turn,
+                    'latency': latency,
+                    'ok': not data.get('error'),
+                    'error': data.get('error')
+                })
+                if data.get('error'):
+                    break
+
+    async def run(self, conversations: int) -> Dict[str, Any]:
+        """
+        負荷試験を実行する
+
+        Args:
+            conversations: 開始する会話の総数
+
         Returns:
-            保存したファイルパス（保存に失敗した場合はNone）
+            ターンごとのレイテンシ集計（summarize() の結果）
         """
-        if not map_data:
-            return None
-        
-        if not filename:
-            filename = f"map_data_{self._get_current_time().replace(':', '-')}.json"
-        
+        self.results = []
+        limits = httpx.Limits(max_connections=self.max_connections,
+                              max_keepalive_connections=self.max_connections)
+        transport = httpx.AsyncHTTPTransport(limits=limits)
+        interval = 1.0 / self.rate if self.rate > 0 else 0.0
+
+        started_at = time.perf_counter()
         try:
-            with open(filename, 'w', encoding='utf-8') as f:
-                json.dump(map_data, f, ensure_ascii=False, indent=2)
-            return filename
-        except Exception as e:
-            print(f"地図データの保存に失敗しました: {e}")
-            return None
-    
-    def _get_current_time(self) -> str:
-        """現在時刻を文字列で取得する"""
-        from datetime import datetime
-        return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            tasks = []
+            for conversation_id in range(conversations):
+                # 応答を待たずに一定間隔で会話を開始する（オープンループ）
+                scheduled_at = started_at + conversation_id * interval
+                delay = scheduled_at - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                tasks.append(asyncio.ensure_future(self._run_conversation(conversation_id, transport)))
+            await asyncio.gather(*tasks)
+        finally:
+            await transport.aclose()
+
+        return self.summarize(time.perf_counter() - started_at)
+
+    def summarize(self, elapsed: float = 0.0) -> Dict[str, Any]:
+        """計測結果をターンごとに集計する"""
+        turns = []
+        for turn in range(len(self.dialogue)):
+            turn_results = [r for r in self.results if r['turn'] == turn]
+            latencies = [r['latency'] for r in turn_results if r['ok']]
+            turns.append({
+                'turn': turn,
+                'message': self.dialogue[turn],
+                'requests': len(turn_results),
+                'errors': sum(1 for r in turn_results if not r['ok']),
+                'p50_ms': round(percentile(latencies, 0.5) * 1000, 1),
+                'p95_ms': round(percentile(latencies, 0.95) * 1000, 1),
+                'max_ms': round(max(latencies) * 1000, 1) if latencies else 0.0
+            })
+
+        return {
+            'elapsed_seconds': round(elapsed, 2),
+            'requests': len(self.results),
+            'errors': sum(1 for r in self.results if not r['ok']),
+            'turns': turns
+        }
+
 
+def run_load_test(base_url: str, conversations: int, rate: float, max_connections: int):
+    """負荷試験を実行して結果を表示する"""
+    generator = LoadGenerator(base_url, rate=rate, max_connections=max_connections)
+    print(f"{conversations}件の会話を毎秒{rate}件のペースで開始します（{base_url}）")
 
-def interactive_chat():
+    report = asyncio.run(generator.run(conversations))
+
+    print(f"\n=== 負荷試験結果（{report['elapsed_seconds']}秒、{report['requests']}リクエスト、"
+          f"エラー{report['errors']}件） ===")
+    for turn in report['turns']:
+        print(f"ターン{turn['turn'] + 1}: {turn['requests']}件 エラー{turn['errors']}件 "
+              f"p50={turn['p50_ms']}ms p95={turn['p95_ms']}ms max={turn['max_ms']}ms  「{turn['message']}」")
+    return report
+
+
+def interactive_chat(base_url: str = "http://localhost:5000"):
     """対話型チャットを開始する"""
-    client = ChatClient()
+    client = ChatClient(base_url)
     
     print("山梨県観光AIコンシェルジュへようこそ！")
     print("メッセージを入力してください（'quit'で終了、'history'で履歴表示、'clear'で履歴クリア）")
@@ -193,5 +432,22 @@ def interactive_chat():
             print(f"予期しないエラーが発生しました: {e}")
 
 
+def main():
+    """コマンドライン引数に応じて対話モードまたは負荷試験モードを起動する"""
+    parser = argparse.ArgumentParser(description="山梨県観光AIコンシェルジュのクライアント")
+    parser.add_argument('--base-url', default=os.getenv('NOMAD_BASE_URL', 'http://localhost:5000'),
+                        help="サーバーのベースURL")
+    parser.add_argument('--load', action='store_true', help="負荷試験モードで起動する")
+    parser.add_argument('--conversations', type=int, default=10, help="負荷試験で開始する会話数")
+    parser.add_argument('--rate', type=float, default=1.0, help="1秒あたりに開始する会話数")
+    parser.add_argument('--max-connections', type=int, default=100, help="最大同時接続数")
+    args = parser.parse_args()
+
+    if args.load:
+        run_load_test(args.base_url, args.conversations, args.rate, args.max_connections)
+    else:
+        interactive_chat(args.base_url)
+
+
 if __name__ == "__main__":
-    interactive_chat()
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -1,20 +1,463 @@
 from flask import Flask, render_template, request, jsonify, session
 from openai import OpenAI
 import os
+import numpy as np
 import polyline
 import requests
 import json
+import copy
+import gzip
+import hashlib
+import math
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
 import re
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 app = Flask(__name__)
 app.secret_key = os.getenv('SECRET_KEY', 'your-secret-key-here')
 
 # OpenAI クライアントの設定
 client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+# プラン生成ではヘッジが唯一の再試行になるよう、SDKの自動再試行を無効にする
+# （締め切り後に再試行が続くのを防ぎ、サーキットブレーカーが実際の呼び出しだけを数えるため）
+plan_client = client.with_options(max_retries=0)
+
+# 旅行プラン生成の出力モード
+# text: 自由文＋JSONブロック（従来）、structured: JSONスキーマによる構造化出力
+PLAN_OUTPUT_MODE = os.getenv('PLAN_OUTPUT_MODE', 'text')
+PLAN_TEXT_MODEL = os.getenv('PLAN_TEXT_MODEL', 'gpt-3.5-turbo')
+PLAN_STRUCTURED_MODEL = os.getenv('PLAN_STRUCTURED_MODEL', 'gpt-4o-mini')
+PLAN_STRUCTURED_MAX_TOKENS = 400
+
+# 構造化出力で使う旅行プランのスキーマ
+TRAVEL_PLAN_SCHEMA = {
+    "name": "travel_plan",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "locations": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "name": {"type": "string"},
+                        "description": {"type": "string"},
+                        "search_query": {"type": "string"}
+                    },
+                    "required": ["name", "description", "search_query"],
+                    "additionalProperties": False
+                }
+            },
+            "route_summary": {"type": "string"},
+            "travel_info": {"type": "string"}
+        },
+        "required": ["locations", "route_summary", "travel_info"],
+        "additionalProperties": False
+    }
+}
+
+# 出力モードごとのトークン使用量と解析失敗の累計（監視用）
+llm_usage_totals = {}
+llm_usage_lock = threading.Lock()
+
+# コンパクトレスポンス形式の設定
+COMPACT_MEDIA_TYPE = 'application/vnd.nomad.compact+json'
+COMPACT_RESPONSE_VERSION = 2
+COORDINATE_PRECISION = 5  # 小数点以下5桁（約1m）
+# この長さ未満のレスポンスは圧縮しない
+COMPRESS_MIN_SIZE = 512
+COMPRESSIBLE_MIMETYPES = ('application/json', COMPACT_MEDIA_TYPE)
+
+# ルートの詳細度（LOD）設定
+MIN_ROUTE_ZOOM = 5
+MAX_ROUTE_ZOOM = 18
+DEFAULT_ROUTE_ZOOM = 12  # 県全体〜市町村程度の表示
+ROUTE_TOLERANCE_PIXELS = 1.0  # 許容する誤差（画面上のピクセル数）
+
+class BoundedCache:
+    """スレッドセーフな上限付きLRUキャッシュ"""
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+# ルートIDごとの元のポリラインと、ズームごとの簡略化済みポリライン
+route_cache = BoundedCache(max_size=256)
+route_lod_cache = BoundedCache(max_size=1024)
+
+# レイテンシ予算（秒）。クライアントのタイムアウト（30秒）より短くする
+REQUEST_DEADLINE_SECONDS = float(os.getenv('REQUEST_DEADLINE_SECONDS', '25'))
+STAGE_BUDGETS = {
+    'llm': float(os.getenv('LLM_BUDGET_SECONDS', '15')),
+    'places': 3.0,
+    'restaurants': 2.0,
+    'route': 3.0
+}
+# この時間内にLLMが応答しなければ同じリクエストをもう一度発行する
+LLM_HEDGE_DELAY_SECONDS = float(os.getenv('LLM_HEDGE_DELAY_SECONDS', '6'))
+
+# 外部APIの並行呼び出し用スレッドプール（地図データ取得の各段階）
+upstream_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='upstream')
+# LLM呼び出し（ヘッジを含む）専用のスレッドプール。応答の遅いLLMが地図データ取得の枠を占有しないよう分ける
+LLM_WORKERS = int(os.getenv('LLM_WORKERS', '8'))
+llm_executor = ThreadPoolExecutor(max_workers=LLM_WORKERS, thread_name_prefix='llm')
+# 成功した旅行プランのキャッシュ（LLMタイムアウト時のフォールバック用）
+plan_cache = BoundedCache(max_size=256)
+
+# 地図データ取得（エンリッチメント）をバックグラウンドで実行するワーカー
+ENRICHMENT_WORKERS = int(os.getenv('ENRICHMENT_WORKERS', '4'))
+ENRICHMENT_DEADLINE_SECONDS = float(os.getenv('ENRICHMENT_DEADLINE_SECONDS', '20'))
+enrichment_executor = ThreadPoolExecutor(max_workers=ENRICHMENT_WORKERS, thread_name_prefix='enrichment')
+# ジョブ内の各段階の外部API呼び出し用（Webリクエストの upstream_executor とは別に確保する）
+enrichment_upstream_executor = ThreadPoolExecutor(max_workers=ENRICHMENT_WORKERS * 4,
+                                                  thread_name_prefix='enrichment-upstream')
+# 未完了（待機中・実行中）のジョブ数の上限。超えた分は地図データを省略して応答する
+ENRICHMENT_MAX_PENDING = int(os.getenv('ENRICHMENT_MAX_PENDING', '32'))
+enrichment_slots = threading.BoundedSemaphore(ENRICHMENT_MAX_PENDING)
+# プランIDごとのエンリッチメントジョブ（古いものから破棄）
+plan_store = BoundedCache(max_size=int(os.getenv('PLAN_STORE_SIZE', '512')))
+PLAN_POLL_INTERVAL_SECONDS = 1
+
+class Deadline:
+    """リクエスト全体の締め切りと各処理段階の時間予算を管理"""
+
+    def __init__(self, seconds=REQUEST_DEADLINE_SECONDS):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def budget(self, stage):
+        """処理段階の予算と残り時間のうち短い方を返す"""
+        return min(STAGE_BUDGETS[stage], self.remaining())
+
+    def stage(self, stage):
+        """処理段階全体の締め切りを返す（段階の予算と全体の残り時間のうち早い方）"""
+        return Deadline(self.budget(stage))
+
+def hedged_call(fn, timeout, hedge_delay=LLM_HEDGE_DELAY_SECONDS):
+    """fn(timeout) を実行し、hedge_delay秒以内に応答がなければ同じ呼び出しを追加で発行する
+
+    先に成功した結果を返す。timeout秒以内に成功しなければ TimeoutError を送出
+    """
+    expires_at = time.monotonic() + timeout
+    futures = [llm_executor.submit(fn, timeout)]
+    hedged = False
+    last_error = None
+
+    while futures:
+        remaining = expires_at - time.monotonic()
+        if remaining <= 0:
+            break
+        wait_time = remaining if hedged else min(remaining, hedge_delay)
+        done, pending = wait(futures, timeout=wait_time, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                return future.result()
+            except Exception as e:
+                last_error = e
+        futures = list(pending)
+
+        # 遅延または失敗した場合は一度だけ追加の呼び出しを発行
+        remaining = expires_at - time.monotonic()
+        if not hedged and remaining > 0:
+            futures.append(llm_executor.submit(fn, remaining))
+            hedged = True
+
+    for future in futures:
+        future.cancel()
+    if last_error is not None and not futures:
+        raise last_error
+    raise TimeoutError(f"{timeout:.1f}秒以内に応答がありませんでした")
+
+class CircuitOpenError(Exception):
+    """サーキットブレーカーが開いているため呼び出しを行わなかった"""
+
+class CircuitBreaker:
+    """外部APIごとのサーキットブレーカー
+
+    直近の呼び出しの失敗率または遅延率がしきい値を超えると open になり、
+    open_seconds 経過後に half_open で1件だけ試験的に呼び出す
+    half_open の間は試験呼び出しの結果だけで状態を決め、それ以前に始まった呼び出しの結果は無視する
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_rate_threshold=0.5, slow_call_seconds=10.0,
+                 slow_call_rate_threshold=0.5, window_size=20, minimum_calls=5, open_seconds=30.0):
+        self.name = name
+        self.failure_rate_threshold = failure_rate_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate_threshold = slow_call_rate_threshold
+        self.minimum_calls = minimum_calls
+        self.open_seconds = open_seconds
+        self.state = self.CLOSED
+        self.opened_at = None
+        self.probe_in_flight = False
+        self.calls = deque(maxlen=window_size)  # (成功したか, 遅延したか)
+        self._lock = threading.Lock()
+
+    def _update_state(self):
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.open_seconds:
+            self.state = self.HALF_OPEN
+            self.probe_in_flight = False
 
-def get_route(origin, destination, api_key):
-    """Google Maps APIを使用して経路を取得する関数"""
+    def _trip(self):
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+        self.probe_in_flight = False
+        self.calls.clear()
+
+    def is_open(self):
+        """呼び出しを即座にスキップすべき状態か（状態は変更しない）"""
+        with self._lock:
+            self._update_state()
+            return self.state == self.OPEN or (self.state == self.HALF_OPEN and self.probe_in_flight)
+
+    def acquire(self):
+        """呼び出しの許可を得る。許可されない場合は CircuitOpenError を送出
+
+        戻り値: half_open の試験呼び出しか（record にそのまま渡す）
+        """
+        with self._lock:
+            self._update_state()
+            if self.state == self.OPEN:
+                raise CircuitOpenError(f"{self.name} のサーキットブレーカーが開いています")
+            if self.state == self.HALF_OPEN:
+                if self.probe_in_flight:
+                    raise CircuitOpenError(f"{self.name} は試験呼び出し中です")
+                self.probe_in_flight = True
+                return True
+            return False
+
+    def record(self, success, latency, probe=False):
+        """呼び出し結果を記録して状態を更新
+
+        probe は acquire の戻り値。1回の acquire につき1回だけ呼び出す
+        """
+        slow = latency >= self.slow_call_seconds
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                if not probe:
+                    return
+                if success and not slow:
+                    self.state = self.CLOSED
+                    self.probe_in_flight = False
+                    self.calls.clear()
+                else:
+                    self._trip()
+                return
+            if self.state == self.OPEN:
+                return
+
+            self.calls.append((success, slow))
+            if len(self.calls) < self.minimum_calls:
+                return
+            failure_rate = sum(1 for ok, _ in self.calls if not ok) / len(self.calls)
+            slow_rate = sum(1 for _, is_slow in self.calls if is_slow) / len(self.calls)
+            if failure_rate >= self.failure_rate_threshold or slow_rate >= self.slow_call_rate_threshold:
+                self._trip()
+
+    def call(self, fn, *args, **kwargs):
+        """ブレーカーを通して fn を呼び出す"""
+        probe = self.acquire()
+        started_at = time.monotonic()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            self.record(False, time.monotonic() - started_at, probe)
+            raise
+        self.record(True, time.monotonic() - started_at, probe)
+        return result
+
+    def snapshot(self):
+        """監視用に現在の状態を返す"""
+        with self._lock:
+            self._update_state()
+            total = len(self.calls)
+            return {
+                "state": self.state,
+                "calls": total,
+                "failure_rate": round(sum(1 for ok, _ in self.calls if not ok) / total, 3) if total else 0.0,
+                "slow_call_rate": round(sum(1 for _, is_slow in self.calls if is_slow) / total, 3) if total else 0.0,
+                "open_remaining_seconds": round(max(0.0, self.open_seconds - (time.monotonic() - self.opened_at)), 1)
+                if self.state == self.OPEN else 0.0
+            }
+
+# 外部APIごとのサーキットブレーカー
+circuit_breakers = {
+    'dify': CircuitBreaker('dify', slow_call_seconds=10.0),
+    'openai': CircuitBreaker('openai', slow_call_seconds=10.0),
+    'google_maps': CircuitBreaker('google_maps', slow_call_seconds=2.0, window_size=50, minimum_calls=10)
+}
+
+# 同時に実行するLLM呼び出しを伴うリクエストの上限と待ち行列の長さ
+MAX_CONCURRENT_PLANS = int(os.getenv('MAX_CONCURRENT_PLANS', '4'))
+ADMISSION_QUEUE_SIZE = int(os.getenv('ADMISSION_QUEUE_SIZE', '8'))
+ADMISSION_MAX_WAIT_SECONDS = float(os.getenv('ADMISSION_MAX_WAIT_SECONDS', '10'))
+
+class AdmissionRejected(Exception):
+    """混雑のためリクエストを受け付けなかった"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class AdmissionController:
+    """LLMを使う重いリクエストの同時実行数を制限する
+
+    上限に達している間は待ち行列で待たせ、待ち行列が満杯か待ち時間が上限を超えた場合は
+    AdmissionRejected を送出する。スロット埋めの軽い質問応答はここを通さないため、混雑中も優先して処理される
+    """
+
+    def __init__(self, max_concurrent, max_queue, max_wait_seconds):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait_seconds = max_wait_seconds
+        self.active = 0
+        self.waiting = 0
+        self.admitted_total = 0
+        self.rejected_total = 0
+        self.timed_out_total = 0
+        self.recent_waits = deque(maxlen=200)  # 直近の待ち時間（秒）
+        self.avg_service_seconds = 10.0  # 処理時間の指数移動平均
+        self._acquired_at = threading.local()
+        self._cond = threading.Condition()
+
+    def _retry_after(self):
+        # 待ち行列が一巡するまでの目安
+        rounds = (self.waiting + self.active) / self.max_concurrent
+        return max(1, int(math.ceil(self.avg_service_seconds * rounds)))
+
+    def acquire(self):
+        """実行枠を確保する。確保できない場合は AdmissionRejected を送出"""
+        started_at = time.monotonic()
+        with self._cond:
+            if self.active >= self.max_concurrent or self.waiting > 0:
+                if self.waiting >= self.max_queue:
+                    self.rejected_total += 1
+                    raise AdmissionRejected("混雑しているため受け付けできませんでした", self._retry_after())
+
+                self.waiting += 1
+                try:
+                    expires_at = started_at + self.max_wait_seconds
+                    while self.active >= self.max_concurrent:
+                        remaining = expires_at - time.monotonic()
+                        if remaining <= 0:
+                            self.timed_out_total += 1
+                            # 待ち時間の統計には時間切れになった待ちも含める
+                            self.recent_waits.append(time.monotonic() - started_at)
+                            raise AdmissionRejected("混雑のため待ち時間が上限を超えました", self._retry_after())
+                        self._cond.wait(remaining)
+                finally:
+                    self.waiting -= 1
+
+            self.active += 1
+            self.admitted_total += 1
+            self.recent_waits.append(time.monotonic() - started_at)
+        self._acquired_at.value = time.monotonic()
+
+    def release(self):
+        """実行枠を解放する"""
+        service_seconds = time.monotonic() - getattr(self._acquired_at, 'value', time.monotonic())
+        with self._cond:
+            self.active -= 1
+            self.avg_service_seconds = 0.8 * self.avg_service_seconds + 0.2 * service_seconds
+            self._cond.notify()
+
+    def snapshot(self):
+        """監視用に現在の状態を返す"""
+        with self._cond:
+            waits = sorted(self.recent_waits)
+            return {
+                "active": self.active,
+                "max_concurrent": self.max_concurrent,
+                "queue_depth": self.waiting,
+                "max_queue": self.max_queue,
+                "admitted_total": self.admitted_total,
+                "rejected_total": self.rejected_total,
+                "timed_out_total": self.timed_out_total,
+                "wait_ms_p50": round(waits[len(waits) // 2] * 1000, 1) if waits else 0.0,
+                "wait_ms_p95": round(waits[int(len(waits) * 0.95)] * 1000, 1) if waits else 0.0,
+                "wait_ms_max": round(waits[-1] * 1000, 1) if waits else 0.0,
+                "avg_service_seconds": round(self.avg_service_seconds, 2)
+            }
+
+plan_admission = AdmissionController(MAX_CONCURRENT_PLANS, ADMISSION_QUEUE_SIZE, ADMISSION_MAX_WAIT_SECONDS)
+
+def plan_cache_key(plan_inputs):
+    """旅行条件からプランキャッシュのキーを生成"""
+    serialized = json.dumps(plan_inputs, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(serialized.encode('utf-8')).hexdigest()
+
+def generate_fallback_plan(plan_inputs):
+    """同じ条件のキャッシュ済みプラン、なければテンプレートのプランを返す"""
+    cached_plan = plan_cache.get(plan_cache_key(plan_inputs))
+    if cached_plan is not None:
+        return cached_plan
+    return {"text": generate_local_response(plan_inputs)}
+
+class MapsApiError(Exception):
+    """Google Maps API がエラーのステータス（OVER_QUERY_LIMIT など）を返した"""
+
+# 該当なしを表すステータス（障害ではないため空の結果として扱う）
+MAPS_EMPTY_STATUSES = ('ZERO_RESULTS', 'NOT_FOUND')
+
+def check_maps_status(data):
+    """Google Maps API の応答ステータスを確認する
+
+    OK なら True、該当なしなら False を返し、それ以外は MapsApiError を送出
+    """
+    status = data.get("status")
+    if status == "OK":
+        return True
+    if status in MAPS_EMPTY_STATUSES:
+        return False
+    raise MapsApiError(f"{status}: {data.get('error_message', '')}")
+
+def get_route(origin, destination, api_key, detailed=False, timeout=None):
+    """Google Maps APIを使用して経路を取得する関数
+
+    detailed=True の場合は各ステップのポリラインを連結した詳細な経路を返す
+    """
     base_url = "https://maps.googleapis.com/maps/api/directions/json?"
     params = {
         "origin": origin,
@@ -23,17 +466,135 @@ def get_route(origin, destination, api_key):
         "key": api_key
     }
     
-    response = requests.get(base_url, params=params)
+    response = requests.get(base_url, params=params, timeout=timeout)
     data = response.json()
     
-    if data["status"] == "OK":
-        route = data["routes"][0]["overview_polyline"]["points"]
-        return route
+    if check_maps_status(data):
+        route = data["routes"][0]
+        if detailed:
+            points = []
+            for leg in route.get("legs", []):
+                for step in leg.get("steps", []):
+                    step_points = polyline.decode(step["polyline"]["points"])
+                    # 連続するステップの接続点の重複を除く
+                    if points and step_points and points[-1] == step_points[0]:
+                        step_points = step_points[1:]
+                    points.extend(step_points)
+            if points:
+                return polyline.encode(points)
+        return route["overview_polyline"]["points"]
     else:
         return None
 
+def parse_zoom(value, default=DEFAULT_ROUTE_ZOOM):
+    """ズームレベルを解析して有効範囲に収める"""
+    try:
+        zoom = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(MIN_ROUTE_ZOOM, min(MAX_ROUTE_ZOOM, zoom))
+
+def zoom_to_tolerance(zoom):
+    """ズームレベルに対応する簡略化の許容誤差（度）を計算"""
+    # Webメルカトルでは1ピクセルあたり 360 / (256 * 2^zoom) 度
+    return ROUTE_TOLERANCE_PIXELS * 360.0 / (256 * 2 ** zoom)
+
+def douglas_peucker(points, tolerance):
+    """Douglas-Peucker法で点列を簡略化する（緯度, 経度のタプルのリスト）"""
+    if len(points) < 3:
+        return list(points)
+
+    # 経度方向の距離を緯度に応じて補正する
+    coords = np.asarray(points, dtype=float)
+    lats = coords[:, 0]
+    lngs = coords[:, 1] * math.cos(math.radians(points[0][0]))
+
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    # 深い再帰を避けるためスタックで処理。区間内の距離はまとめて計算する
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        y1, x1 = lats[start], lngs[start]
+        y2, x2 = lats[end], lngs[end]
+        dx = x2 - x1
+        dy = y2 - y1
+        segment_length = math.hypot(dx, dy)
+
+        y0 = lats[start + 1:end]
+        x0 = lngs[start + 1:end]
+        if segment_length == 0:
+            distances = np.hypot(x0 - x1, y0 - y1)
+        else:
+            distances = np.abs(dy * x0 - dx * y0 + x2 * y1 - y2 * x1) / segment_length
+
+        offset = int(np.argmax(distances))
+        if distances[offset] > tolerance:
+            index = start + 1 + offset
+            keep[index] = True
+            stack.append((start, index))
+            stack.append((index, end))
+
+    return [point for point, kept in zip(points, keep) if kept]
+
+def simplify_polyline(encoded_polyline, zoom):
+    """エンコード済みポリラインをズームレベルに合わせて簡略化する"""
+    points = polyline.decode(encoded_polyline)
+    simplified = douglas_peucker(points, zoom_to_tolerance(zoom))
+    return polyline.encode(simplified), len(simplified)
 
-def get_place_suggestions(query, location, api_key):
+def register_route(encoded_polyline):
+    """ポリラインをキャッシュに登録してルートIDを返す"""
+    route_id = hashlib.sha1(encoded_polyline.encode('utf-8')).hexdigest()[:16]
+    if route_id not in route_cache:
+        route_cache.set(route_id, encoded_polyline)
+    return route_id
+
+def get_route_lod(route_id, zoom):
+    """指定したズームレベルの簡略化済みポリラインを取得（ルートごとにキャッシュ）"""
+    cache_key = (route_id, zoom)
+    cached = route_lod_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    encoded_polyline = route_cache.get(route_id)
+    if encoded_polyline is None:
+        return None
+
+    simplified, point_count = simplify_polyline(encoded_polyline, zoom)
+    lod = {
+        "route_id": route_id,
+        "zoom": zoom,
+        "polyline": simplified,
+        "points": point_count
+    }
+    route_lod_cache.set(cache_key, lod)
+    return lod
+
+def build_route_data(resolved_locations, api_key, zoom=DEFAULT_ROUTE_ZOOM, timeout=None):
+    """最初と最後の地点を結ぶルートを取得し、指定の詳細度で返す"""
+    if len(resolved_locations) < 2:
+        return None
+
+    origin = f"{resolved_locations[0]['lat']},{resolved_locations[0]['lng']}"
+    destination = f"{resolved_locations[-1]['lat']},{resolved_locations[-1]['lng']}"
+    route_polyline = get_route(origin, destination, api_key, detailed=True, timeout=timeout)
+    if not route_polyline:
+        return None
+
+    lod = get_route_lod(register_route(route_polyline), zoom)
+    return {
+        "route_id": lod["route_id"],
+        "zoom": lod["zoom"],
+        "polyline": lod["polyline"],
+        "origin": resolved_locations[0]["name"],
+        "destination": resolved_locations[-1]["name"]
+    }
+
+
+def get_place_suggestions(query, location, api_key, timeout=None):
     """Google Places APIを使用して場所の候補を取得する関数"""
     base_url = "https://maps.googleapis.com/maps/api/place/textsearch/json?"
     params = {
@@ -43,15 +604,15 @@ def get_place_suggestions(query, location, api_key):
         "key": api_key
     }
     
-    response = requests.get(base_url, params=params)
+    response = requests.get(base_url, params=params, timeout=timeout)
     data = response.json()
     
-    if data["status"] == "OK":
+    if check_maps_status(data):
         return data["results"]
     else:
         return []
 
-def get_restaurants_near_location(lat, lng, api_key, radius=2000):
+def get_restaurants_near_location(lat, lng, api_key, radius=2000, timeout=None):
     """指定された座標周辺の飲食店を取得する関数"""
     base_url = "https://maps.googleapis.com/maps/api/place/nearbysearch/json?"
     params = {
@@ -61,10 +622,10 @@ def get_restaurants_near_location(lat, lng, api_key, radius=2000):
         "key": api_key
     }
     
-    response = requests.get(base_url, params=params)
+    response = requests.get(base_url, params=params, timeout=timeout)
     data = response.json()
     
-    if data["status"] == "OK":
+    if check_maps_status(data):
         restaurants = []
         for place in data["results"][:5]:  # 上位5件のみ取得
             if place.get("rating", 0) >= 3.0:  # 評価3.0以上のみ
@@ -81,6 +642,118 @@ def get_restaurants_near_location(lat, lng, api_key, radius=2000):
     else:
         return []
 
+# 飲食店ランキングの重み（合計1.0）
+RANKING_WEIGHTS = {
+    'rating': 0.4,
+    'price': 0.2,
+    'cuisine': 0.25,
+    'distance': 0.15
+}
+DEFAULT_RESTAURANT_COUNT = 8
+DISTANCE_SCALE_METERS = 1000.0  # この距離で距離スコアが約0.37まで下がる
+EARTH_RADIUS_METERS = 6371000.0
+
+# 予算（1食あたりの円）の上限と対応する price_level
+BUDGET_PRICE_LEVELS = [(1000, 1), (3000, 2), (6000, 3)]
+
+# 食事の好みごとの店名キーワード
+CUISINE_KEYWORDS = {
+    '和食': ['和食', '割烹', '料亭', '定食', 'そば', '蕎麦', 'うどん', 'ほうとう', '天ぷら'],
+    '洋食': ['洋食', 'グリル', 'ハンバーグ', 'オムライス', 'ステーキ'],
+    '中華': ['中華', '中国料理', '餃子', '飯店', '酒家'],
+    'イタリアン': ['イタリア', 'パスタ', 'ピザ', 'ピッツァ', 'trattoria', 'osteria', 'pizza', 'italian'],
+    'フレンチ': ['フレンチ', 'フランス', 'ビストロ', 'bistro', 'french'],
+    'ラーメン': ['ラーメン', 'らーめん', '拉麺', 'ramen'],
+    '寿司': ['寿司', '鮨', 'すし', 'sushi'],
+    '焼肉': ['焼肉', 'ホルモン', 'yakiniku'],
+    'カフェ': ['カフェ', '珈琲', 'コーヒー', '喫茶', 'cafe', 'coffee']
+}
+
+# アンケートフォーム（/survey）の food の値と CUISINE_KEYWORDS のキーの対応
+SURVEY_FOOD_PREFERENCES = {
+    'japanese': '和食',
+    'western': '洋食',
+    'chinese': '中華',
+    'cafe': 'カフェ'
+}
+
+def budget_to_price_level(budget):
+    """予算（円）をGoogle Placesのprice_level（0〜4）に変換"""
+    if budget is None or budget == "":
+        return None
+    try:
+        amount = int(re.sub(r'[^\d]', '', str(budget)))
+    except ValueError:
+        return None
+    for upper_limit, price_level in BUDGET_PRICE_LEVELS:
+        if amount <= upper_limit:
+            return price_level
+    return 4
+
+def rank_restaurants(restaurants, stops, budget=None, food_preference=None, k=DEFAULT_RESTAURANT_COUNT):
+    """評価・予算との適合・料理の好み・最寄りの観光地からの距離で飲食店を採点し、上位k件を返す"""
+    if not restaurants:
+        return []
+
+    count = len(restaurants)
+
+    # 料理の好みのキーワードを1つの正規表現にまとめる
+    # 'any'・空・未知の値は好みの指定なしとして扱う
+    food_preference = SURVEY_FOOD_PREFERENCES.get(food_preference, food_preference)
+    keywords = CUISINE_KEYWORDS.get(food_preference)
+    cuisine_pattern = re.compile('|'.join(map(re.escape, keywords)), re.IGNORECASE) if keywords else None
+
+    # 候補ごとの特徴量を1回の走査で配列にまとめる（欠損値はNaN）
+    nan = float('nan')
+    features = np.array([
+        (
+            r.get("rating") if isinstance(r.get("rating"), (int, float)) else nan,
+            r.get("price_level") if isinstance(r.get("price_level"), (int, float)) else nan,
+            1.0 if cuisine_pattern and cuisine_pattern.search(r.get("name", "")) else 0.0,
+            r["lat"],
+            r["lng"]
+        )
+        for r in restaurants
+    ], dtype=float)
+
+    # 評価（3.0〜5.0 を 0〜1 に正規化、評価なしは0）
+    rating_score = np.nan_to_num(np.clip((features[:, 0] - 3.0) / 2.0, 0.0, 1.0), nan=0.0)
+
+    # 予算との適合（価格帯の差が小さいほど高い、情報がなければ0.5）
+    target_level = budget_to_price_level(budget)
+    if target_level is None:
+        price_score = np.full(count, 0.5)
+    else:
+        price_score = np.nan_to_num(1.0 - np.abs(features[:, 1] - target_level) / 4.0, nan=0.5)
+
+    # 料理の好みとの一致（店名にキーワードを含むか、指定がなければ0.5）
+    cuisine_score = features[:, 2] if cuisine_pattern else np.full(count, 0.5)
+
+    # 最寄りの観光地までの距離（正距円筒図法による近似）
+    if stops:
+        restaurant_coords = np.radians(features[:, 3:5])
+        stop_coords = np.radians(np.array([[s["lat"], s["lng"]] for s in stops], dtype=float))
+        delta_lat = restaurant_coords[:, None, 0] - stop_coords[None, :, 0]
+        mean_lat = (restaurant_coords[:, None, 0] + stop_coords[None, :, 0]) / 2.0
+        delta_lng = (restaurant_coords[:, None, 1] - stop_coords[None, :, 1]) * np.cos(mean_lat)
+        distances = EARTH_RADIUS_METERS * np.sqrt(delta_lat ** 2 + delta_lng ** 2).min(axis=1)
+        distance_score = np.exp(-distances / DISTANCE_SCALE_METERS)
+    else:
+        distance_score = np.zeros(count)
+
+    scores = (RANKING_WEIGHTS['rating'] * rating_score
+              + RANKING_WEIGHTS['price'] * price_score
+              + RANKING_WEIGHTS['cuisine'] * cuisine_score
+              + RANKING_WEIGHTS['distance'] * distance_score)
+
+    # 上位k件だけを部分ソートで取り出してから並べ替える
+    if count > k:
+        top_indices = np.argpartition(-scores, k - 1)[:k]
+    else:
+        top_indices = np.arange(count)
+    top_indices = top_indices[np.argsort(-scores[top_indices], kind='stable')]
+    return [restaurants[i] for i in top_indices]
+
 def create_google_maps_url(locations, restaurants=None, route_polyline=None):
     """Google Mapsの埋め込みURLを生成"""
     if not locations:
@@ -114,37 +787,83 @@ def create_google_maps_url(locations, restaurants=None, route_polyline=None):
     
     return url
 
+def record_llm_usage(mode, usage=None, parse_failed=False):
+    """出力モードごとのトークン使用量と解析失敗の回数を集計"""
+    with llm_usage_lock:
+        totals = llm_usage_totals.setdefault(mode, {
+            "requests": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "generation_ms": 0,
+            "parse_failures": 0
+        })
+        if usage:
+            totals["requests"] += 1
+            totals["prompt_tokens"] += usage.get("prompt_tokens") or 0
+            totals["completion_tokens"] += usage.get("completion_tokens") or 0
+            totals["generation_ms"] += usage.get("generation_ms") or 0
+        if parse_failed:
+            totals["parse_failures"] += 1
+
+def summarize_llm_usage(response, mode, started_at):
+    """APIレスポンスから1リクエスト分のトークン使用量を取り出す"""
+    usage = response.usage
+    return {
+        "mode": mode,
+        "model": response.model,
+        "prompt_tokens": usage.prompt_tokens if usage else None,
+        "completion_tokens": usage.completion_tokens if usage else None,
+        "total_tokens": usage.total_tokens if usage else None,
+        "generation_ms": int((time.monotonic() - started_at) * 1000)
+    }
+
+def parse_structured_plan(content):
+    """構造化出力のJSONをスキーマどおりに読み込み、場所のリストを返す"""
+    travel_data = json.loads(content)
+    locations = [{
+        "name": loc["name"],
+        "description": loc["description"],
+        "search_query": loc["search_query"] or loc["name"]
+    } for loc in travel_data["locations"]]
+    return travel_data, locations
+
+def render_structured_plan(travel_data):
+    """構造化出力からユーザー向けの文章を組み立てる"""
+    lines = ["おすすめの旅行プランをご提案します！", "", travel_data["route_summary"], ""]
+    for loc in travel_data["locations"]:
+        lines.append(f"・「{loc['name']}」{loc['description']}")
+    lines.extend(["", travel_data["travel_info"], "", "素敵な旅行をお楽しみください！"])
+    return "\n".join(lines)
+
+def parse_fenced_json(ai_response):
+    """応答文の ```json ブロックを読み込む。ブロックがない場合も ValueError を送出"""
+    if "```json" not in ai_response:
+        raise ValueError("JSONブロックが見つかりません")
+    json_start = ai_response.find("```json") + 7
+    json_end = ai_response.find("```", json_start)
+    json_str = ai_response[json_start:json_end].strip()
+    return json.loads(json_str)
+
+def locations_from_travel_data(travel_data):
+    """旅行情報のJSONから場所のリストを取り出す"""
+    locations = []
+    if "locations" in travel_data:
+        for loc in travel_data["locations"]:
+            locations.append({
+                "name": loc.get("name", ""),
+                "description": loc.get("description", ""),
+                "search_query": loc.get("search_query", loc.get("name", ""))
+            })
+    return locations
+
 def extract_travel_info_from_ai_response(ai_response):
     """AIの応答から旅行情報を抽出する"""
-    locations = []
-    
     # JSONフォーマットの応答を解析
     try:
-        if "```json" in ai_response:
-            json_start = ai_response.find("```json") + 7
-            json_end = ai_response.find("```", json_start)
-            json_str = ai_response[json_start:json_end].strip()
-            travel_data = json.loads(json_str)
-            
-            if "locations" in travel_data:
-                for loc in travel_data["locations"]:
-                    locations.append({
-                        "name": loc.get("name", ""),
-                        "description": loc.get("description", ""),
-                        "search_query": loc.get("search_query", loc.get("name", ""))
-                    })
-        else:
-            # テキストから場所を抽出（従来の方法）
-            location_pattern = r'「([^」]+)」'
-            location_names = re.findall(location_pattern, ai_response)
-            for name in location_names:
-                locations.append({
-                    "name": name,
-                    "description": "",
-                    "search_query": name
-                })
-    except:
+        return locations_from_travel_data(parse_fenced_json(ai_response))
+    except (ValueError, TypeError, AttributeError):
         # フォールバック：テキストから場所を抽出
+        locations = []
         location_pattern = r'「([^」]+)」'
         location_names = re.findall(location_pattern, ai_response)
         for name in location_names:
@@ -153,8 +872,7 @@ def extract_travel_info_from_ai_response(ai_response):
                 "description": "",
                 "search_query": name
             })
-    
-    return locations
+        return locations
 
 def get_conversation_state():
     """現在の会話状態を取得"""
@@ -247,6 +965,466 @@ def generate_next_question(state):
     
     return None, 'complete'
 
+def wants_compact_response():
+    """クライアントがコンパクトレスポンス形式を要求しているか判定"""
+    version = request.args.get('v') or request.args.get('version')
+    if version == str(COMPACT_RESPONSE_VERSION) or request.args.get('format') == 'compact':
+        return True
+
+    for mimetype, quality in request.accept_mimetypes:
+        if mimetype == COMPACT_MEDIA_TYPE and quality > 0:
+            return True
+    return False
+
+def round_coordinates(item):
+    """緯度経度を丸め、空の値を取り除いたコピーを返す"""
+    compact_item = {}
+    for key, value in item.items():
+        if value is None or value == "" or value == "N/A":
+            continue
+        if key in ("lat", "lng") and isinstance(value, float):
+            value = round(value, COORDINATE_PRECISION)
+        compact_item[key] = value
+    return compact_item
+
+def build_compact_payload(ai_message, map_data, restaurants_data, route_data, extra=None):
+    """重複を除いたコンパクト形式のペイロードを構築"""
+    payload = {"v": COMPACT_RESPONSE_VERSION, "response": ai_message}
+
+    if map_data:
+        payload["map_url"] = map_data["url"]
+        payload["locations"] = [round_coordinates(loc) for loc in map_data["locations"]]
+    if restaurants_data:
+        payload["restaurants"] = [round_coordinates(r) for r in restaurants_data]
+    if route_data:
+        payload["route"] = route_data
+    if extra:
+        payload.update(extra)
+
+    return payload
+
+def build_plan_response(ai_message, map_data=None, restaurants_data=None, route_data=None, extra=None):
+    """/chat と /survey のレスポンスを要求された形式で生成"""
+    restaurants_data = restaurants_data or []
+
+    if wants_compact_response():
+        payload = build_compact_payload(ai_message, map_data, restaurants_data, route_data, extra)
+        response = app.response_class(
+            json.dumps(payload, ensure_ascii=False, separators=(',', ':')),
+            content_type=f'{COMPACT_MEDIA_TYPE}; charset=utf-8'
+        )
+    else:
+        # 従来形式（既存クライアントとの互換性のため）
+        payload = {
+            "response": ai_message,
+            "map_data": map_data,
+            "locations": map_data["locations"] if map_data else [],
+            "restaurants": restaurants_data,
+            "route": route_data
+        }
+        if extra:
+            payload.update(extra)
+        response = jsonify(payload)
+
+    response.vary.add('Accept')
+    return response
+
+def select_content_encoding():
+    """Accept-Encodingから利用する圧縮方式を選択"""
+    accept_encodings = request.accept_encodings
+    if brotli is not None and accept_encodings['br'] > 0:
+        return 'br'
+    if accept_encodings['gzip'] > 0:
+        return 'gzip'
+    return None
+
+@app.after_request
+def compress_response(response):
+    """JSONレスポンスをgzip/brotliで圧縮"""
+    if (response.direct_passthrough
+            or response.status_code < 200
+            or response.status_code >= 300
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES
+            or 'Content-Encoding' in response.headers):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+
+    encoding = select_content_encoding()
+    if encoding == 'br':
+        response.set_data(brotli.compress(data))
+    elif encoding == 'gzip':
+        response.set_data(gzip.compress(data, compresslevel=6))
+    else:
+        return response
+
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+# 地図データ取得で想定する失敗（その段階の結果を省いて処理を続ける）
+MAPS_CALL_ERRORS = (requests.RequestException, ValueError, KeyError, MapsApiError, CircuitOpenError)
+
+def run_stage_calls(stage, calls, stage_deadline, executor=upstream_executor):
+    """同じ処理段階の外部API呼び出しを並行実行し、段階の締め切りまでに終わった結果だけを返す
+
+    calls は (ログ用ラベル, fn(timeout)) のリスト、executor は呼び出しを実行するスレッドプール
+    戻り値: (結果のリスト（失敗・未完了は None）, すべて成功したか)
+    """
+    if not calls:
+        return [], True
+    if stage_deadline.expired():
+        return [None] * len(calls), False
+
+    futures = [executor.submit(fn, stage_deadline.remaining()) for _, fn in calls]
+    # requests の timeout は接続・読み込みごとの上限なので、段階全体の上限はここで待つ時間で決める
+    done, _ = wait(futures, timeout=stage_deadline.remaining())
+
+    results = []
+    complete = True
+    for (label, _), future in zip(calls, futures):
+        if future not in done:
+            future.cancel()
+            app.logger.warning("%s の時間予算内に終わりませんでした (%s)", stage, label)
+            results.append(None)
+            complete = False
+            continue
+        try:
+            results.append(future.result())
+        except MAPS_CALL_ERRORS as e:
+            app.logger.warning("%s の取得に失敗しました (%s): %s", stage, label, e)
+            results.append(None)
+            complete = False
+    return results, complete
+
+def enrich_travel_locations(travel_locations, api_key, zoom, deadline, preferences=None,
+                            executor=upstream_executor):
+    """場所の座標・周辺飲食店・ルートを取得して地図データを構築
+
+    preferences の budget と food_preference は飲食店のランキングに使用する
+    executor は各段階の外部API呼び出しを実行するスレッドプール
+
+    時間予算を超えた段階や失敗した段階はスキップし、取得できた分だけを返す
+    戻り値: (map_data, restaurants_data, route_data, skipped_stages)
+    """
+    resolved_locations = []
+    all_restaurants = []
+    skipped_stages = []
+    maps_breaker = circuit_breakers['google_maps']
+
+    # 各場所の座標を並行して取得（段階全体で時間予算を共有）
+    place_results, complete = run_stage_calls('places', [
+        # ユーザーの要望に合わせて地域を特定しない（全世界対応）
+        (location_info['search_query'],
+         lambda timeout, query=location_info['search_query']: maps_breaker.call(
+             get_place_suggestions, query, "35.6762,139.6503", api_key, timeout=timeout))
+        for location_info in travel_locations
+    ], deadline.stage('places'), executor)
+    if not complete:
+        skipped_stages.append('places')
+
+    for location_info, places in zip(travel_locations, place_results):
+        if places:
+            place = places[0]
+            resolved_locations.append({
+                "name": location_info["name"],
+                "description": location_info["description"],
+                "lat": place["geometry"]["location"]["lat"],
+                "lng": place["geometry"]["location"]["lng"],
+                "address": place.get("formatted_address", ""),
+                "place_id": place["place_id"]
+            })
+
+    # 各場所周辺の飲食店を並行して検索
+    restaurant_results, complete = run_stage_calls('restaurants', [
+        (resolved_location["name"],
+         lambda timeout, loc=resolved_location: maps_breaker.call(
+             get_restaurants_near_location, loc["lat"], loc["lng"], api_key, timeout=timeout))
+        for resolved_location in resolved_locations
+    ], deadline.stage('restaurants'), executor)
+    if not complete:
+        skipped_stages.append('restaurants')
+    for restaurants in restaurant_results:
+        all_restaurants.extend(restaurants or [])
+
+    # 重複する飲食店を除去（place_idで判定）
+    unique_restaurants = []
+    seen_place_ids = set()
+    for restaurant in all_restaurants:
+        if restaurant["place_id"] not in seen_place_ids:
+            unique_restaurants.append(restaurant)
+            seen_place_ids.add(restaurant["place_id"])
+
+    # 評価・予算・料理の好み・距離で採点して上位8件
+    preferences = preferences or {}
+    restaurants_data = rank_restaurants(
+        unique_restaurants,
+        resolved_locations,
+        budget=preferences.get('budget'),
+        food_preference=preferences.get('food_preference')
+    )
+
+    # ルートを生成（複数地点がある場合）
+    route_data = None
+    if len(resolved_locations) >= 2:
+        route_results, complete = run_stage_calls('route', [
+            ("route", lambda timeout: maps_breaker.call(
+                build_route_data, resolved_locations, api_key, zoom, timeout=timeout))
+        ], deadline.stage('route'), executor)
+        route_data = route_results[0]
+        if not complete:
+            skipped_stages.append('route')
+
+    # Google Maps埋め込みURLを生成
+    map_data = None
+    if resolved_locations:
+        google_maps_url = create_google_maps_url(resolved_locations, restaurants_data,
+                                                 route_data["polyline"] if route_data else None)
+        if google_maps_url:
+            map_data = {
+                "url": google_maps_url,
+                "locations": resolved_locations,
+                "restaurants": restaurants_data,
+                "route": route_data
+            }
+
+    # 重複を除いて順序を保つ
+    skipped_stages = list(OrderedDict.fromkeys(skipped_stages))
+    return map_data, restaurants_data, route_data, skipped_stages
+
+def wants_async_enrichment():
+    """クライアントが地図データの非同期取得を要求しているか判定"""
+    if request.args.get('async', '').lower() in ('1', 'true'):
+        return True
+    return 'respond-async' in request.headers.get('Prefer', '')
+
+def run_enrichment_job(plan_id, travel_locations, api_key, zoom, deadline, preferences=None):
+    """バックグラウンドでジョブを実行し、終了後に未完了ジョブの枠を解放する
+
+    deadline は登録時点から数えるため、待ち行列で待った時間も予算に含まれる
+    """
+    try:
+        execute_enrichment_job(plan_id, travel_locations, api_key, zoom, deadline, preferences)
+    finally:
+        enrichment_slots.release()
+
+def execute_enrichment_job(plan_id, travel_locations, api_key, zoom, deadline, preferences=None):
+    """地図データを取得してジョブストアに保存"""
+    job = plan_store.get(plan_id)
+    if job is None:
+        return
+    plan_store.set(plan_id, dict(job, status='running'))
+
+    try:
+        map_data, restaurants_data, route_data, skipped_stages = enrich_travel_locations(
+            travel_locations, api_key, zoom, deadline, preferences, enrichment_upstream_executor
+        )
+    except Exception as e:
+        app.logger.exception("エンリッチメントジョブに失敗しました (%s)", plan_id)
+        plan_store.set(plan_id, dict(job, status='failed', error=str(e), finished_at=time.time()))
+        return
+
+    plan_store.set(plan_id, dict(
+        job,
+        status='done',
+        map_data=map_data,
+        restaurants=restaurants_data,
+        route=route_data,
+        skipped=skipped_stages,
+        finished_at=time.time()
+    ))
+
+def submit_enrichment_job(ai_message, travel_locations, api_key, zoom, preferences=None):
+    """エンリッチメントジョブを登録してプランIDを返す
+
+    未完了のジョブが上限に達している場合は登録せずに None を返す
+    """
+    if not enrichment_slots.acquire(blocking=False):
+        return None
+    deadline = Deadline(ENRICHMENT_DEADLINE_SECONDS)
+    plan_id = uuid.uuid4().hex
+    plan_store.set(plan_id, {
+        "plan_id": plan_id,
+        "status": 'pending',
+        "response": ai_message,
+        "created_at": time.time()
+    })
+    enrichment_executor.submit(run_enrichment_job, plan_id, travel_locations, api_key, zoom, deadline, preferences)
+    return plan_id
+
+def build_travel_plan_response(ai_message, zoom, deadline, extra=None, preferences=None, travel_locations=None):
+    """AIの応答から地図データを付加したレスポンスを生成
+
+    travel_locations を渡した場合（構造化出力）は応答文からの抽出を省く
+    非同期モードでは地図データを待たずにプランIDを返し、GET /plan/<plan_id> で取得させる
+    """
+    # 旅行情報を抽出
+    if travel_locations is None:
+        travel_locations = extract_travel_info_from_ai_response(ai_message)
+
+    map_data = None
+    restaurants_data = []
+    route_data = None
+    extra = dict(extra or {})
+
+    # Google Maps APIキーを取得
+    api_key = os.getenv('GOOGLE_MAPS_API_KEY')
+
+    if travel_locations and api_key:
+        if circuit_breakers['google_maps'].is_open():
+            # Google Mapsが不調の間は地図データの取得を省略する
+            skipped_stages = ['maps']
+        elif wants_async_enrichment():
+            plan_id = submit_enrichment_job(ai_message, travel_locations, api_key, zoom, preferences)
+            if plan_id is None:
+                # 未完了のジョブが多すぎる間は地図データの取得を省略する
+                skipped_stages = ['maps']
+            else:
+                extra["plan_id"] = plan_id
+                extra["plan_status"] = 'pending'
+                extra["plan_url"] = f"/plan/{plan_id}"
+                skipped_stages = []
+        else:
+            map_data, restaurants_data, route_data, skipped_stages = enrich_travel_locations(
+                travel_locations, api_key, zoom, deadline, preferences
+            )
+        if skipped_stages:
+            extra["partial"] = True
+            extra["skipped"] = skipped_stages
+
+    return build_plan_response(ai_message, map_data, restaurants_data, route_data, extra or None)
+
+def call_dify(survey_data, dify_url, dify_api_key, timeout):
+    """Dify APIで旅行プランを生成"""
+    # Difyに送信するデータを構築
+    dify_payload = {
+        "inputs": {
+            "origin": survey_data.get('origin', ''),
+            "destination": survey_data.get('destination', ''),
+            "transport": survey_data.get('transport', ''),
+            "budget": survey_data.get('budget', ''),
+            "time": survey_data.get('time', ''),
+            "food": survey_data.get('food', '')
+        },
+        "response_mode": "blocking",
+        "user": "nomad-user"
+    }
+
+    headers = {
+        'Authorization': f'Bearer {dify_api_key}',
+        'Content-Type': 'application/json'
+    }
+
+    dify_response = requests.post(dify_url, json=dify_payload, headers=headers, timeout=timeout)
+    if dify_response.status_code != 200:
+        raise RuntimeError(f"Dify APIエラー: {dify_response.status_code}")
+
+    dify_data = dify_response.json()
+    return dify_data.get('data', {}).get('outputs', {}).get('text', '')
+
+def call_openai(messages, timeout):
+    """ChatGPT APIで旅行プランを生成（自由文＋JSONブロック）"""
+    started_at = time.monotonic()
+    response = plan_client.chat.completions.create(
+        model=PLAN_TEXT_MODEL,
+        messages=messages,
+        max_tokens=800,
+        temperature=0.7,
+        timeout=timeout
+    )
+    usage = summarize_llm_usage(response, 'text', started_at)
+    ai_message = response.choices[0].message.content
+
+    # JSONブロックがない・壊れている場合は解析失敗として数え、後段で「」から場所を抽出する
+    try:
+        locations = locations_from_travel_data(parse_fenced_json(ai_message))
+    except (ValueError, TypeError, AttributeError):
+        record_llm_usage('text', usage, parse_failed=True)
+        return {"text": ai_message, "usage": usage}
+
+    record_llm_usage('text', usage)
+    return {"text": ai_message, "locations": locations, "usage": usage}
+
+def call_openai_structured(messages, timeout):
+    """ChatGPT APIで旅行プランを生成（JSONスキーマによる構造化出力）"""
+    started_at = time.monotonic()
+    response = plan_client.chat.completions.create(
+        model=PLAN_STRUCTURED_MODEL,
+        messages=messages,
+        max_tokens=PLAN_STRUCTURED_MAX_TOKENS,
+        temperature=0.7,
+        response_format={"type": "json_schema", "json_schema": TRAVEL_PLAN_SCHEMA},
+        timeout=timeout
+    )
+    usage = summarize_llm_usage(response, 'structured', started_at)
+
+    try:
+        travel_data, locations = parse_structured_plan(response.choices[0].message.content)
+    except (TypeError, ValueError, KeyError) as e:
+        # 拒否や出力の途切れなど。呼び出し失敗として扱いフォールバックさせる
+        record_llm_usage('structured', usage, parse_failed=True)
+        raise ValueError(f"構造化出力を解析できませんでした: {e}")
+
+    record_llm_usage('structured', usage)
+    return {"text": render_structured_plan(travel_data), "locations": locations, "usage": usage}
+
+def build_structured_plan_messages(context_info, user_message):
+    """構造化出力モード用のプロンプト（書式はスキーマで指定するため説明を省く）"""
+    return [
+        {"role": "system", "content": f"""あなたは旅行コンシェルジュAIです。以下の情報をもとに、予算・時間・食事の好みを考慮した旅行ルートを提案してください。
+        {context_info}
+        locations には立ち寄る場所を訪問順に、search_query にはGoogle検索用のクエリを入れてください。各項目は簡潔に。"""},
+        {"role": "user", "content": f"旅行プランを作成してください。最新のリクエスト: {user_message}"}
+    ]
+
+def generate_plan_within_budget(fn, plan_inputs, deadline, source):
+    """時間予算内でLLMを呼び出し、間に合わなければフォールバックのプランを返す
+
+    source は circuit_breakers のキー。ブレーカーが開いている場合は呼び出さずにフォールバックする
+    fn は応答文字列、または {"text", "locations", "usage"} の辞書を返す
+    戻り値: (プランの辞書, フォールバックを使用したか)
+    """
+    breaker = circuit_breakers[source]
+    try:
+        probe = breaker.acquire()
+    except CircuitOpenError:
+        return generate_fallback_plan(plan_inputs), True
+
+    # 元の呼び出しとヘッジの呼び出しは合わせて1件の結果としてブレーカーに記録する
+    started_at = time.monotonic()
+    try:
+        plan = hedged_call(fn, deadline.budget('llm'))
+    except Exception as e:
+        breaker.record(False, time.monotonic() - started_at, probe)
+        app.logger.warning("%sの呼び出しに失敗したためフォールバックします: %s", source, e)
+        return generate_fallback_plan(plan_inputs), True
+    breaker.record(True, time.monotonic() - started_at, probe)
+
+    if isinstance(plan, str):
+        plan = {"text": plan}
+    # トークン使用量はリクエストごとの値なのでキャッシュしない
+    plan_cache.set(plan_cache_key(plan_inputs), {"text": plan["text"], "locations": plan.get("locations")})
+    return plan, False
+
+def plan_response_extra(plan, used_fallback):
+    """フォールバックの有無とトークン使用量をレスポンスに付加する"""
+    extra = {}
+    if used_fallback:
+        extra["fallback"] = True
+    if plan.get("usage"):
+        extra["usage"] = plan["usage"]
+    return extra or None
+
+@app.errorhandler(AdmissionRejected)
+def handle_admission_rejected(e):
+    """混雑時はすぐに503を返し、再試行までの目安を伝える"""
+    response = jsonify({"error": str(e), "retry_after": e.retry_after})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -254,133 +1432,43 @@ def index():
 @app.route('/survey', methods=['POST'])
 def survey():
     survey_data = request.json
+    zoom = parse_zoom(request.args.get('zoom', survey_data.get('zoom')))
+    deadline = Deadline()
     
+    # Dify APIへのリクエスト準備
+    dify_url = os.getenv('DIFY_API_URL')
+    dify_api_key = os.getenv('DIFY_API_KEY')
+    use_dify = bool(dify_url and dify_api_key)
+    
+    # Difyを使う重い処理は同時実行数を制限（満杯なら503）。テンプレートの応答は対象外
+    if use_dify:
+        plan_admission.acquire()
     try:
-        # Dify APIへのリクエスト準備
-        dify_url = os.getenv('DIFY_API_URL')
-        dify_api_key = os.getenv('DIFY_API_KEY')
-        
-        if dify_url and dify_api_key:
-            # Difyに送信するデータを構築
-            dify_payload = {
-                "inputs": {
-                    "origin": survey_data.get('origin', ''),
-                    "destination": survey_data.get('destination', ''),
-                    "transport": survey_data.get('transport', ''),
-                    "budget": survey_data.get('budget', ''),
-                    "time": survey_data.get('time', ''),
-                    "food": survey_data.get('food', '')
-                },
-                "response_mode": "blocking",
-                "user": "nomad-user"
-            }
-            
-            # Dify APIにリクエスト
-            headers = {
-                'Authorization': f'Bearer {dify_api_key}',
-                'Content-Type': 'application/json'
-            }
-            
-            dify_response = requests.post(dify_url, json=dify_payload, headers=headers)
-            
-            if dify_response.status_code == 200:
-                dify_data = dify_response.json()
-                ai_message = dify_data.get('data', {}).get('outputs', {}).get('text', '')
-            else:
-                # Dify失敗時はローカル処理にフォールバック
-                ai_message = generate_local_response(survey_data)
+        if use_dify:
+            # 時間予算内にDifyが応答しなければローカル処理にフォールバック
+            plan, used_fallback = generate_plan_within_budget(
+                lambda timeout: call_dify(survey_data, dify_url, dify_api_key, timeout),
+                survey_data, deadline, 'dify'
+            )
         else:
             # Dify設定がない場合はローカル処理
-            ai_message = generate_local_response(survey_data)
-        
-        # 旅行情報を抽出
-        travel_locations = extract_travel_info_from_ai_response(ai_message)
-        
-        map_data = None
-        restaurants_data = []
-        route_data = None
+            plan = {"text": generate_local_response(survey_data)}
+            used_fallback = False
         
-        # Google Maps APIキーを取得
-        api_key = os.getenv('GOOGLE_MAPS_API_KEY')
-        
-        if travel_locations and api_key:
-            resolved_locations = []
-            all_restaurants = []
-            
-            # 各場所の座標を取得
-            for location_info in travel_locations:
-                location_query = location_info['search_query']
-                places = get_place_suggestions(location_query, "35.6762,139.6503", api_key)
-                
-                if places:
-                    place = places[0]
-                    resolved_location = {
-                        "name": location_info["name"],
-                        "description": location_info["description"],
-                        "lat": place["geometry"]["location"]["lat"],
-                        "lng": place["geometry"]["location"]["lng"],
-                        "address": place.get("formatted_address", ""),
-                        "place_id": place["place_id"]
-                    }
-                    resolved_locations.append(resolved_location)
-                    
-                    # 各場所周辺の飲食店を検索
-                    restaurants = get_restaurants_near_location(
-                        resolved_location["lat"], 
-                        resolved_location["lng"], 
-                        api_key
-                    )
-                    all_restaurants.extend(restaurants)
-            
-            # 重複する飲食店を除去
-            unique_restaurants = []
-            seen_place_ids = set()
-            for restaurant in all_restaurants:
-                if restaurant["place_id"] not in seen_place_ids:
-                    unique_restaurants.append(restaurant)
-                    seen_place_ids.add(restaurant["place_id"])
-            
-            # 評価順でソート
-            unique_restaurants.sort(key=lambda x: x.get("rating", 0), reverse=True)
-            restaurants_data = unique_restaurants[:8]
-            
-            # ルートを生成
-            if len(resolved_locations) >= 2:
-                origin = f"{resolved_locations[0]['lat']},{resolved_locations[0]['lng']}"
-                destination = f"{resolved_locations[-1]['lat']},{resolved_locations[-1]['lng']}"
-                route_polyline = get_route(origin, destination, api_key)
-                if route_polyline:
-                    route_data = {
-                        "polyline": route_polyline,
-                        "origin": resolved_locations[0]["name"],
-                        "destination": resolved_locations[-1]["name"]
-                    }
-            
-            # Google Maps埋め込みURLを生成
-            if resolved_locations:
-                google_maps_url = create_google_maps_url(resolved_locations, restaurants_data, 
-                                                       route_data["polyline"] if route_data else None)
-                
-                if google_maps_url:
-                    map_data = {
-                        "url": google_maps_url,
-                        "locations": resolved_locations,
-                        "restaurants": restaurants_data,
-                        "route": route_data
-                    }
-        
-        return jsonify({
-            "response": ai_message,
-            "map_data": map_data,
-            "locations": map_data["locations"] if map_data else [],
-            "restaurants": restaurants_data,
-            "route": route_data
-        })
+        preferences = {
+            'budget': survey_data.get('budget'),
+            'food_preference': survey_data.get('food')
+        }
+        return build_travel_plan_response(plan["text"], zoom, deadline, plan_response_extra(plan, used_fallback),
+                                          preferences, plan.get("locations"))
     
     except Exception as e:
         return jsonify({
             "error": str(e)
         }), 500
+    finally:
+        if use_dify:
+            plan_admission.release()
 
 def generate_local_response(survey_data):
     """ローカルでの旅行プラン生成（Dify失敗時のフォールバック）"""
@@ -423,9 +1511,13 @@ def generate_local_response(survey_data):
 @app.route('/chat', methods=['POST'])
 def chat():
     user_message = request.json.get('message', '')
+    zoom = parse_zoom(request.args.get('zoom', request.json.get('zoom')))
+    deadline = Deadline()
     
     # 会話状態を取得
     state = get_conversation_state()
+    # 混雑で受け付けなかった場合に戻せるよう、変更前の会話状態を控えておく
+    original_state = copy.deepcopy(state)
     
     # ユーザー入力を分析
     extracted_info = analyze_user_input(user_message, state)
@@ -447,12 +1539,7 @@ def chat():
         state['messages'].append({"role": "assistant", "content": ai_response})
         session['conversation_state'] = state
         
-        return jsonify({
-            "response": ai_response,
-            "map_data": None,
-            "locations": [],
-            "restaurants": [],
-            "route": None,
+        return build_plan_response(ai_response, extra={
             "conversation_state": {
                 "step": next_step,
                 "collected_info": state['collected_info']
@@ -499,107 +1586,82 @@ def chat():
         5. 親しみやすく、実用的な情報を含めて応答"""},
         {"role": "user", "content": f"収集した情報をもとに旅行プランを作成してください。最新のリクエスト: {user_message}"}
     ]
+    call_llm = call_openai
+
+    if PLAN_OUTPUT_MODE == 'structured':
+        # 構造化出力モード：JSONスキーマで出力させ、応答文はサーバー側で組み立てる
+        messages = build_structured_plan_messages(context_info, user_message)
+        call_llm = call_openai_structured
+
+    # LLMを使う重い処理は同時実行数を制限（満杯なら503）
     try:
-        # ChatGPT APIを呼び出し
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=messages,
-            max_tokens=800,
-            temperature=0.7
+        plan_admission.acquire()
+    except AdmissionRejected:
+        # 再試行で同じメッセージが会話履歴に重複しないよう、会話状態を変更前に戻す
+        session['conversation_state'] = original_state
+        raise
+    try:
+        # ChatGPT APIを呼び出し（時間予算を超えた場合はフォールバック）
+        plan, used_fallback = generate_plan_within_budget(
+            lambda timeout: call_llm(messages, timeout),
+            collected, deadline, 'openai'
         )
         
-        # APIレスポンスから回答を取得
-        ai_message = response.choices[0].message.content
-        
-        # 旅行情報を抽出
-        travel_locations = extract_travel_info_from_ai_response(ai_message)
-        
-        map_data = None
-        restaurants_data = []
-        route_data = None
-        
-        # Google Maps APIキーを取得
-        api_key = os.getenv('GOOGLE_MAPS_API_KEY')
-        
-        if travel_locations and api_key:
-            resolved_locations = []
-            all_restaurants = []
-            
-            # 各場所の座標を取得
-            for location_info in travel_locations:
-                # ユーザーの要望に合わせて地域を特定しない（全世界対応）
-                location_query = location_info['search_query']
-                places = get_place_suggestions(location_query, "35.6762,139.6503", api_key)  # 東京を中心とした検索
-                
-                if places:
-                    place = places[0]
-                    resolved_location = {
-                        "name": location_info["name"],
-                        "description": location_info["description"],
-                        "lat": place["geometry"]["location"]["lat"],
-                        "lng": place["geometry"]["location"]["lng"],
-                        "address": place.get("formatted_address", ""),
-                        "place_id": place["place_id"]
-                    }
-                    resolved_locations.append(resolved_location)
-                    
-                    # 各場所周辺の飲食店を検索
-                    restaurants = get_restaurants_near_location(
-                        resolved_location["lat"], 
-                        resolved_location["lng"], 
-                        api_key
-                    )
-                    all_restaurants.extend(restaurants)
-            
-            # 重複する飲食店を除去（place_idで判定）
-            unique_restaurants = []
-            seen_place_ids = set()
-            for restaurant in all_restaurants:
-                if restaurant["place_id"] not in seen_place_ids:
-                    unique_restaurants.append(restaurant)
-                    seen_place_ids.add(restaurant["place_id"])
-            
-            # 評価順でソート
-            unique_restaurants.sort(key=lambda x: x.get("rating", 0), reverse=True)
-            restaurants_data = unique_restaurants[:8]  # 上位8件
-            
-            # ルートを生成（複数地点がある場合）
-            if len(resolved_locations) >= 2:
-                origin = f"{resolved_locations[0]['lat']},{resolved_locations[0]['lng']}"
-                destination = f"{resolved_locations[-1]['lat']},{resolved_locations[-1]['lng']}"
-                route_polyline = get_route(origin, destination, api_key)
-                if route_polyline:
-                    route_data = {
-                        "polyline": route_polyline,
-                        "origin": resolved_locations[0]["name"],
-                        "destination": resolved_locations[-1]["name"]
-                    }
-            
-            # Google Maps埋め込みURLを生成
-            if resolved_locations:
-                google_maps_url = create_google_maps_url(resolved_locations, restaurants_data, 
-                                                       route_data["polyline"] if route_data else None)
-                
-                if google_maps_url:
-                    map_data = {
-                        "url": google_maps_url,
-                        "locations": resolved_locations,
-                        "restaurants": restaurants_data,
-                        "route": route_data
-                    }
-        
-        return jsonify({
-            "response": ai_message,
-            "map_data": map_data,
-            "locations": map_data["locations"] if map_data else [],
-            "restaurants": restaurants_data,
-            "route": route_data
-        })
+        return build_travel_plan_response(plan["text"], zoom, deadline, plan_response_extra(plan, used_fallback),
+                                          collected, plan.get("locations"))
     
     except Exception as e:
         return jsonify({
             "error": str(e)
         }), 500
+    finally:
+        plan_admission.release()
+
+@app.route('/route/<route_id>', methods=['GET'])
+def get_route_detail(route_id):
+    """指定したズームレベルのルートポリラインを返す"""
+    zoom = parse_zoom(request.args.get('zoom'))
+    lod = get_route_lod(route_id, zoom)
+    if lod is None:
+        return jsonify({"error": "ルートが見つかりません"}), 404
+    return jsonify(lod)
+
+@app.route('/plan/<plan_id>', methods=['GET'])
+def get_plan(plan_id):
+    """非同期で取得した地図データ（エンリッチメント）の状態と結果を返す"""
+    job = plan_store.get(plan_id)
+    if job is None:
+        return jsonify({"error": "プランが見つかりません"}), 404
+
+    if job["status"] in ('pending', 'running'):
+        response = jsonify({"plan_id": plan_id, "status": job["status"]})
+        response.headers['Retry-After'] = str(PLAN_POLL_INTERVAL_SECONDS)
+        return response
+
+    if job["status"] == 'failed':
+        return jsonify({"plan_id": plan_id, "status": job["status"], "error": job.get("error")})
+
+    extra = {"plan_id": plan_id, "status": job["status"]}
+    if job.get("skipped"):
+        extra["partial"] = True
+        extra["skipped"] = job["skipped"]
+    return build_plan_response(job["response"], job["map_data"], job["restaurants"], job["route"], extra)
+
+@app.route('/health/circuits', methods=['GET'])
+def circuit_status():
+    """外部APIのサーキットブレーカーの状態を返す（監視用）"""
+    return jsonify({name: breaker.snapshot() for name, breaker in circuit_breakers.items()})
+
+@app.route('/health/llm', methods=['GET'])
+def llm_usage_status():
+    """出力モードごとのトークン使用量・生成時間・解析失敗の累計を返す（監視用）"""
+    with llm_usage_lock:
+        return jsonify({mode: dict(totals) for mode, totals in llm_usage_totals.items()})
+
+@app.route('/health/admission', methods=['GET'])
+def admission_status():
+    """LLMを使うリクエストの同時実行数・待ち行列・待ち時間を返す（監視用）"""
+    return jsonify(plan_admission.snapshot())
 
 @app.route('/share', methods=['POST'])
 def create_share_link():